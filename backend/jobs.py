@@ -0,0 +1,191 @@
+from datetime import datetime, timedelta, timezone
+import threading
+from sqlalchemy import select, update, delete, or_, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import Job, JobStatus
+
+import logging
+logger = logging.getLogger(__name__)
+
+# A running job whose worker has not finished it within this window is assumed
+# to belong to a dead worker and becomes claimable again.
+LEASE_TIMEOUT = timedelta(minutes=15)
+# Running jobs renew their lease this often, so long handlers are not reclaimed
+HEARTBEAT_INTERVAL = LEASE_TIMEOUT / 3
+RETRY_BACKOFF = timedelta(seconds=30)
+MAX_ATTEMPTS = 5
+# DONE jobs are deleted after this long; FAILED ones are kept for inspection
+RETENTION = timedelta(days=7)
+
+HANDLERS = {}
+
+
+def handler(kind: str):
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+def enqueue(db: Session, kind: str, dedupe_key: str = None, run_at: datetime = None, max_attempts: int = MAX_ATTEMPTS, **payload):
+    # Not committed here, so the job lands atomically with the caller's own
+    # changes. Returns None if a job with the same dedupe_key is already pending.
+    query = (
+        insert(Job)
+        .values(
+            kind=kind,
+            dedupe_key=dedupe_key,
+            payload=payload,
+            status=JobStatus.QUEUED,
+            attempts=0,
+            max_attempts=max_attempts,
+            run_at=run_at or utcnow(),
+        )
+        .on_conflict_do_nothing(
+            index_elements=[Job.dedupe_key],
+            index_where=text("status IN ('QUEUED', 'RUNNING')"),
+        )
+        .returning(Job.id)
+    )
+    return db.execute(query).scalar_one_or_none()
+
+
+def claim(db: Session, worker_id: str):
+    now = utcnow()
+    query = (
+        select(Job)
+        .where(or_(
+            (Job.status == JobStatus.QUEUED) & (Job.run_at <= now),
+            (Job.status == JobStatus.RUNNING) & (Job.locked_at < now - LEASE_TIMEOUT),
+        ))
+        .order_by(Job.run_at, Job.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    while True:
+        job = db.execute(query).scalar_one_or_none()
+        if job is None:
+            db.commit()
+            return None
+
+        if job.status == JobStatus.RUNNING and job.attempts >= job.max_attempts:
+            # Its last attempt died with the worker
+            job.status = JobStatus.FAILED
+            job.last_error = f"Lease expired on {job.locked_by}"
+            job.locked_by = None
+            job.locked_at = None
+            db.commit()
+            continue
+
+        job.status = JobStatus.RUNNING
+        job.attempts += 1
+        job.locked_by = worker_id
+        job.locked_at = now
+        db.commit()
+        return job
+
+
+def _release(db: Session, job_id: int, worker_id: str, **values):
+    # Only applies while this worker still holds the lease: if it expired and
+    # another worker reclaimed the job, that worker owns the outcome.
+    result = db.execute(
+        update(Job)
+        .where(Job.id == job_id, Job.locked_by == worker_id, Job.status == JobStatus.RUNNING)
+        .values(locked_by=None, locked_at=None, **values)
+    )
+    db.commit()
+    if result.rowcount == 0:
+        logger.warning(f"Worker {worker_id} lost the lease on job {job_id}; result discarded")
+        return False
+    return True
+
+
+def complete(db: Session, job_id: int, worker_id: str):
+    return _release(db, job_id, worker_id, status=JobStatus.DONE, last_error=None)
+
+
+def fail(db: Session, job_id: int, worker_id: str, attempts: int, max_attempts: int, error: str, retry: bool = True):
+    if retry and attempts < max_attempts:
+        return _release(
+            db, job_id, worker_id,
+            status=JobStatus.QUEUED,
+            run_at=utcnow() + RETRY_BACKOFF * 2 ** (attempts - 1),
+            last_error=error,
+        )
+    return _release(db, job_id, worker_id, status=JobStatus.FAILED, last_error=error)
+
+
+def prune(db: Session):
+    # run_at is when the last attempt became due, so a DONE job finished after it
+    result = db.execute(
+        delete(Job)
+        .where(Job.status == JobStatus.DONE, Job.run_at < utcnow() - RETENTION)
+    )
+    db.commit()
+    return result.rowcount
+
+
+def heartbeat(job_id: int, worker_id: str, stop: threading.Event):
+    while not stop.wait(HEARTBEAT_INTERVAL.total_seconds()):
+        db: Session = SessionLocal()
+        try:
+            result = db.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.locked_by == worker_id, Job.status == JobStatus.RUNNING)
+                .values(locked_at=utcnow())
+            )
+            db.commit()
+            if result.rowcount == 0:
+                logger.warning(f"Worker {worker_id} lost the lease on job {job_id}")
+                return
+        except Exception as e:
+            logger.error(f"Failed to renew lease on job {job_id}: {str(e)}")
+        finally:
+            db.close()
+
+
+def run_next(worker_id: str):
+    db: Session = SessionLocal()
+    try:
+        job = claim(db, worker_id)
+        if job is None:
+            return False
+        job_id, kind, payload = job.id, job.kind, job.payload
+        attempts, max_attempts = job.attempts, job.max_attempts
+    finally:
+        # No transaction may stay open on jobs while the handler runs
+        db.close()
+
+    func = HANDLERS.get(kind)
+    error = None
+    if func is None:
+        error = f"Unknown job kind: {kind}"
+        logger.error(f"No handler registered for job {job_id} ({kind})")
+    else:
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat, args=(job_id, worker_id, stop), daemon=True)
+        beat.start()
+        try:
+            func(**payload)
+        except Exception as e:
+            error = str(e)
+            logger.error(f"Job {job_id} ({kind}) failed on attempt {attempts}: {error}")
+        finally:
+            stop.set()
+            beat.join()
+
+    db = SessionLocal()
+    try:
+        if error is not None:
+            fail(db, job_id, worker_id, attempts, max_attempts, error, retry=func is not None)
+        elif complete(db, job_id, worker_id):
+            logger.info(f"Job {job_id} ({kind}) done")
+    finally:
+        db.close()
+    return True
@@ -2,12 +2,13 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from database import engine
 import models
-from routers import user_auth, spotify_auth
+from routers import user_auth, spotify_auth, usage
 
 app = FastAPI()
 
 app.include_router(user_auth.router)
 app.include_router(spotify_auth.router)
+app.include_router(usage.router)
 
 origins = [
     "https://subsense.vercel.app",
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date, Enum, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date, Enum, DateTime, Boolean, JSON, Index, UniqueConstraint, text
 from sqlalchemy.orm import relationship
 import enum
 from database import Base
@@ -7,6 +7,12 @@ class BillingCycle(enum.Enum):
     MONTHLY = "monthly"
     YEARLY = "yearly"
 
+class JobStatus(enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
 class User(Base):
     __tablename__ = "users"
 
@@ -39,6 +45,7 @@ class Subscription(Base):
 
 class AppUsageStats(Base):
     __tablename__ = "app_usage_stats"
+    __table_args__ = (UniqueConstraint("user_id", "app_name", "date", name="uq_app_usage_stats_user_app_date"),)
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -50,3 +57,24 @@ class AppUsageStats(Base):
 
     user = relationship("User", back_populates="app_usage_stats")
     subscription = relationship("Subscription", back_populates="usage")
+
+class Job(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (
+        Index("ix_jobs_status_run_at", "status", "run_at"),
+        # At most one pending job per dedupe key; finished jobs free it up again
+        Index("uq_jobs_dedupe_key_pending", "dedupe_key", unique=True,
+              postgresql_where=text("status IN ('QUEUED', 'RUNNING')")),
+    )
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    dedupe_key = Column(String, nullable=True)
+    payload = Column(JSON, nullable=False, default=dict)
+    status = Column(Enum(JobStatus), nullable=False, default=JobStatus.QUEUED)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=5)
+    run_at = Column(DateTime(timezone=True), nullable=False)
+    locked_by = Column(String, nullable=True)
+    locked_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(String, nullable=True)
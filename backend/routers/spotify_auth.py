@@ -1,9 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, Request, BackgroundTasks, Header
+from fastapi import APIRouter, Depends, HTTPException, Request, Header
 from fastapi.responses import RedirectResponse, HTMLResponse
 import httpx
-import models, auth
+import models, auth, jobs
 from typing import Annotated
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
 from database import SessionLocal
 from dotenv import load_dotenv
 import os
@@ -301,6 +302,7 @@ def get_recommendation(email: str):
         db.close()
 
 
+@jobs.handler("renewal_email")
 def send_renewal_email(user_email, user_name=None):
     status = get_recommendation(user_email)
     link = f"{RENEW_SUB_URL}?email={user_email}"
@@ -325,79 +327,117 @@ def send_renewal_email(user_email, user_name=None):
         logger.info(f"Renewal email sent to {user_email}")
     except Exception as e:
         logger.error(f"Failed to send renewal email to {user_email}: {str(e)}")
+        raise
 
 
-def fetch_recently_played_for_all_users():
+@jobs.handler("ingest_usage")
+def ingest_user_usage(user_id: int, date: str, after: int, refreshed: bool = False):
     db: Session = SessionLocal()
     try:
-        users = db.query(models.User).filter(models.User.spotify_access_token.isnot(None)).all()
-        today = datetime.now(ZoneInfo("Asia/Kolkata")).date()
-        for user in users:
-            try:
-                # Check for Spotify subscription renewal
-                subscription = db.query(models.Subscription).filter_by(user_id=user.id, app_name="Spotify", is_active=1).first()
-                if subscription and subscription.next_billing_date == today:
-                    # Mark subscription as inactive
-                    subscription.is_active = 0
-                    # Disconnect Spotify
-                    user.spotify_access_token = None
-                    user.spotify_refresh_token = None
-                    user.spotify_token_expires_at = None
-                    db.commit()
-                    # Send renewal email
-                    send_renewal_email(user.email, getattr(user, 'name', None))
-                    logger.info(f"Processed renewal for user {user.email}")
-                headers = {"Authorization": f"Bearer {user.spotify_access_token}"} if user.spotify_access_token else None
-                if headers:
-                    with httpx.Client() as client:
-                        yesterday = datetime.now(ZoneInfo("Asia/Kolkata")) - timedelta(days=1)
-                        timestamp = int(yesterday.timestamp() * 1000)
-                        response = client.get(f"https://api.spotify.com/v1/me/player/recently-played?after={timestamp}", headers=headers)
-                        if response.status_code == 401:  # Token expired, refresh
-                            try:
-                                new_token = refresh_spotify_token_sync(user, db)
-                                headers = {"Authorization": f"Bearer {new_token}"}
-                                response = client.get(f"https://api.spotify.com/v1/me/player/recently-played?after={timestamp}", headers=headers)
-                            except Exception as e:
-                                logger.error(f"Error refreshing token for user {user.email}: {str(e)}")
-                        if response.status_code == 200:
-                            data = response.json()
-                            tracks_today = 0
-                            while True:
-                                for item in data.get("items", []):
-                                    tracks_today += 1
-                                next_url = data.get("next")
-                                if not next_url:
-                                    break
-                                response = client.get(next_url, headers=headers)
-                                if response.status_code != 200:
-                                    logger.error(f"Error fetching next page for user {user.email}: {response.text}")
-                                    break
-                                data = response.json()
-
-                            usage_stats = models.AppUsageStats(
-                                user_id=user.id,
-                                subscription_id=subscription.id if subscription else None,
-                                app_name="Spotify",
-                                date=today,
-                                is_active=False if tracks_today == 0 else True,
-                                total_usage=tracks_today
-                            )
-                            existing = db.query(models.AppUsageStats).filter_by(user_id=user.id, app_name="Spotify", date=today).first()
-                            if not existing:
-                                db.add(usage_stats)
-                                db.commit()
-            except Exception as e:
-                logger.error(f"Error fetching recently played for user {user.email}: {str(e)}")
+        user = db.query(models.User).filter(models.User.id == user_id).first()
+        if not user or not user.spotify_access_token:
+            return
+        today = datetime.fromisoformat(date).date()
+
+        # Check for Spotify subscription renewal. The row lock makes a second
+        # run for the same user wait, then see the subscription as inactive.
+        subscription = db.query(models.Subscription).filter_by(user_id=user.id, app_name="Spotify", is_active=1).with_for_update().first()
+        if subscription and subscription.next_billing_date == today:
+            # Mark subscription as inactive
+            subscription.is_active = 0
+            # Disconnect Spotify
+            user.spotify_access_token = None
+            user.spotify_refresh_token = None
+            user.spotify_token_expires_at = None
+            # Queue the renewal email in the same transaction
+            jobs.enqueue(db, "renewal_email", dedupe_key=f"renewal_email:{user.id}:{date}", user_email=user.email, user_name=getattr(user, 'name', None))
+            db.commit()
+            logger.info(f"Processed renewal for user {user.email}")
+            return
+        subscription_id = subscription.id if subscription else None
+        # Release the row lock before calling Spotify; this also reloads the
+        # user, in case a concurrent run just processed the renewal
+        db.commit()
+        if not user.spotify_access_token:
+            return
+
+        existing = db.query(models.AppUsageStats).filter_by(user_id=user.id, app_name="Spotify", date=today).first()
+        if existing:
+            return
+
+        headers = {"Authorization": f"Bearer {user.spotify_access_token}"}
+        with httpx.Client() as client:
+            # The window is fixed when the job is queued, so late runs and
+            # retries still count the same tracks for this date
+            response = client.get(f"https://api.spotify.com/v1/me/player/recently-played?after={after}", headers=headers)
+            if response.status_code == 401:  # Token expired, refresh and come back
+                if refreshed:
+                    raise Exception("Spotify token rejected after refresh")
+                jobs.enqueue(db, "refresh_token", dedupe_key=f"refresh_token:{user.id}:{date}", user_id=user.id, date=date, after=after)
+                db.commit()
+                return
+            if response.status_code != 200:
+                raise Exception(f"Spotify returned {response.status_code}: {response.text}")
+
+            data = response.json()
+            tracks_today = 0
+            while True:
+                for item in data.get("items", []):
+                    tracks_today += 1
+                next_url = data.get("next")
+                if not next_url:
+                    break
+                response = client.get(next_url, headers=headers)
+                if response.status_code != 200:
+                    # Retry the whole job rather than store a partial count
+                    raise Exception(f"Error fetching next page for user {user.email}: {response.text}")
+                data = response.json()
+
+        # A concurrent run for the same date may have stored its row first
+        db.execute(
+            insert(models.AppUsageStats)
+            .values(
+                user_id=user.id,
+                subscription_id=subscription_id,
+                app_name="Spotify",
+                date=today,
+                is_active=False if tracks_today == 0 else True,
+                total_usage=tracks_today
+            )
+            .on_conflict_do_nothing(index_elements=["user_id", "app_name", "date"])
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+@jobs.handler("refresh_token")
+def refresh_user_token(user_id: int, date: str, after: int):
+    db: Session = SessionLocal()
+    try:
+        user = db.query(models.User).filter(models.User.id == user_id).first()
+        if not user or not user.spotify_refresh_token:
+            return
+        # Added before the refresh so its commit also persists the follow-up
+        # ingestion; a failed refresh rolls both back and the job is retried.
+        jobs.enqueue(db, "ingest_usage", dedupe_key=f"ingest_usage:{user.id}:{date}:refreshed", user_id=user.id, date=date, after=after, refreshed=True)
+        refresh_spotify_token_sync(user, db)
     finally:
         db.close()
 
 
 @router.post("/fetch-recently-played")
-def fetch_recently_played(background_tasks: BackgroundTasks, x_api_key: str = Header(...)):
+def fetch_recently_played(db: db_dependency, x_api_key: str = Header(...)):
     if x_api_key != CRON_SECRET:
         raise HTTPException(status_code=403, detail="Unauthorized")
-    
-    background_tasks.add_task(fetch_recently_played_for_all_users)
-    return {"message": "Background task started to fetch recently played tracks for all users."}
 
+    now = datetime.now(ZoneInfo("Asia/Kolkata"))
+    today = now.date()
+    after = int((now - timedelta(days=1)).timestamp() * 1000)
+    user_ids = db.query(models.User.id).filter(models.User.spotify_access_token.isnot(None)).all()
+    queued = 0
+    for (user_id,) in user_ids:
+        if jobs.enqueue(db, "ingest_usage", dedupe_key=f"ingest_usage:{user_id}:{today.isoformat()}", user_id=user_id, date=today.isoformat(), after=after):
+            queued += 1
+    db.commit()
+    return {"message": f"Queued recently played fetch for {queued} users."}
@@ -0,0 +1,43 @@
+from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi.responses import StreamingResponse
+import models, auth
+import usage_export
+from dotenv import load_dotenv
+import os
+load_dotenv()
+
+# Separate from CRON_SECRET, which is shared with the scheduler and should
+# only be able to queue work, not read every user's history
+EXPORT_API_KEY = os.getenv("EXPORT_API_KEY")
+
+router = APIRouter(prefix="/api/usage", tags=["usage"])
+
+
+def export_response(fmt: str, user_id: int = None, filename: str = "usage"):
+    if fmt not in usage_export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format. Use one of: {', '.join(usage_export.FORMATS)}")
+    if fmt == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Parquet export is not available on this server")
+
+    return StreamingResponse(
+        usage_export.stream_usage_export(fmt, user_id),
+        media_type=usage_export.MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'},
+    )
+
+
+@router.get("/export")
+def export_usage(format: str = "csv", current_user: models.User = Depends(auth.get_current_user)):
+    return export_response(format, current_user.id, f"usage-{current_user.id}")
+
+
+@router.get("/export/all")
+def export_all_usage(format: str = "csv", user_id: int = None, x_api_key: str = Header(...)):
+    if not EXPORT_API_KEY or x_api_key != EXPORT_API_KEY:
+        raise HTTPException(status_code=403, detail="Unauthorized")
+
+    filename = f"usage-{user_id}" if user_id is not None else "usage-all"
+    return export_response(format, user_id, filename)
@@ -0,0 +1,207 @@
+import argparse
+import csv
+import io
+import json
+import sys
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from database import SessionLocal
+import models
+
+# Rows fetched per round trip. With psycopg2, yield_per opens a server-side
+# cursor, so only this many rows are ever held in Python at once.
+CHUNK_SIZE = 5000
+
+# Parquet buffers fetched chunks up to this many rows per row group. Tiny row
+# groups make the file slow to scan; this bounds memory at one row group.
+ROW_GROUP_SIZE = 100000
+
+FORMATS = ("csv", "ndjson", "parquet")
+
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+COLUMNS = ("id", "user_id", "subscription_id", "app_name", "date", "is_active", "total_usage")
+
+
+def iter_usage_chunks(db: Session, user_id: int = None, chunk_size: int = CHUNK_SIZE):
+    query = select(
+        models.AppUsageStats.id,
+        models.AppUsageStats.user_id,
+        models.AppUsageStats.subscription_id,
+        models.AppUsageStats.app_name,
+        models.AppUsageStats.date,
+        models.AppUsageStats.is_active,
+        models.AppUsageStats.total_usage,
+    ).order_by(models.AppUsageStats.id)
+    if user_id is not None:
+        query = query.where(models.AppUsageStats.user_id == user_id)
+
+    result = db.execute(query.execution_options(yield_per=chunk_size))
+    try:
+        for rows in result.partitions():
+            yield rows
+    finally:
+        result.close()
+
+
+def encode_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for rows in chunks:
+        for row in rows:
+            writer.writerow([
+                row.id,
+                row.user_id,
+                row.subscription_id,
+                row.app_name,
+                row.date.isoformat() if row.date else None,
+                row.is_active,
+                row.total_usage,
+            ])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate(0)
+    # Header only, for an empty export
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def encode_ndjson(chunks):
+    for rows in chunks:
+        lines = [
+            json.dumps({
+                "id": row.id,
+                "user_id": row.user_id,
+                "subscription_id": row.subscription_id,
+                "app_name": row.app_name,
+                "date": row.date.isoformat() if row.date else None,
+                "is_active": row.is_active,
+                "total_usage": row.total_usage,
+            })
+            for row in rows
+        ]
+        yield ("\n".join(lines) + "\n").encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands back whatever was written since the last drain.
+
+    ParquetWriter records absolute offsets in the footer, so tell() has to keep
+    counting even though the underlying bytes are released after every chunk.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def encode_parquet(chunks, row_group_size: int = ROW_GROUP_SIZE):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export requires the pyarrow package")
+
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("user_id", pa.int64()),
+        ("subscription_id", pa.int64()),
+        ("app_name", pa.string()),
+        ("date", pa.date32()),
+        ("is_active", pa.bool_()),
+        ("total_usage", pa.int64()),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+
+    def write_row_group(rows):
+        columns = list(zip(*rows))
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+            schema=schema,
+        ), row_group_size=len(rows))
+        return sink.drain()
+
+    try:
+        pending = []
+        for rows in chunks:
+            pending.extend(rows)
+            if len(pending) >= row_group_size:
+                yield write_row_group(pending)
+                pending = []
+        if pending:
+            yield write_row_group(pending)
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {
+    "csv": encode_csv,
+    "ndjson": encode_ndjson,
+    "parquet": encode_parquet,
+}
+
+
+def stream_usage_export(fmt: str, user_id: int = None, chunk_size: int = CHUNK_SIZE):
+    # Opens its own session: a StreamingResponse keeps iterating after the
+    # request dependencies have already been torn down.
+    db: Session = SessionLocal()
+    try:
+        yield from ENCODERS[fmt](iter_usage_chunks(db, user_id, chunk_size))
+    finally:
+        db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export app usage history.")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--email", help="Only export this user's usage (default: all users)")
+    parser.add_argument("--output", "-o", help="Output file (default: stdout)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    user_id = None
+    if args.email:
+        db: Session = SessionLocal()
+        try:
+            user = db.query(models.User).filter(models.User.email == args.email).first()
+        finally:
+            db.close()
+        if not user:
+            parser.error(f"User not found: {args.email}")
+        user_id = user.id
+
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for data in stream_usage_export(args.format, user_id, args.chunk_size):
+            out.write(data)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+import sys
+import time
+from sqlalchemy import inspect
+from database import engine, SessionLocal
+import models
+import jobs
+import routers.spotify_auth  # noqa: F401  registers the Spotify job handlers
+
+logger = logging.getLogger(__name__)
+
+PRUNE_INTERVAL = 3600
+
+
+def has_usage_unique_key():
+    # Ingestion inserts with ON CONFLICT on these columns, which Postgres
+    # rejects outright unless a matching unique constraint exists
+    columns = {"user_id", "app_name", "date"}
+    return any(
+        set(constraint["column_names"]) == columns
+        for constraint in inspect(engine).get_unique_constraints("app_usage_stats")
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a SubSense job queue worker.")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="Seconds to wait when the queue is empty")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    models.Base.metadata.create_all(bind=engine)
+    if not has_usage_unique_key():
+        logger.error("app_usage_stats is missing its (user_id, app_name, date) unique constraint; see Upgrading in the README")
+        sys.exit(1)
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        # Let the current job finish; anything left running is picked up
+        # by another worker once its lease expires.
+        logger.info(f"Worker {worker_id} stopping")
+        stopping.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    logger.info(f"Worker {worker_id} started")
+    last_prune = None
+    while not stopping.is_set():
+        try:
+            if jobs.run_next(worker_id):
+                continue
+            # Queue is empty, a good moment for housekeeping
+            if last_prune is None or time.monotonic() - last_prune >= PRUNE_INTERVAL:
+                db = SessionLocal()
+                try:
+                    pruned = jobs.prune(db)
+                finally:
+                    db.close()
+                last_prune = time.monotonic()
+                if pruned:
+                    logger.info(f"Worker {worker_id} pruned {pruned} finished jobs")
+        except Exception as e:
+            logger.error(f"Worker {worker_id} could not reach the queue: {str(e)}")
+        stopping.wait(args.poll_interval)
+
+
+if __name__ == "__main__":
+    main()